@@ -3,7 +3,10 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import os
 from dataclasses import dataclass, field
+from multiprocessing import Pool
+from typing import List, Optional
 
 from fairseq.data.encoders import register_tokenizer
 from fairseq.dataclass import FairseqDataclass
@@ -45,5 +48,41 @@ class MosesTokenizer(object):
             escape=(not self.cfg.moses_no_escape),
         )
 
+    def encode_batch(
+        self, xs: List[str], num_workers: Optional[int] = None
+    ) -> List[str]:
+        """Tokenize a list of strings, spread across *num_workers* processes
+        (defaults to the number of CPUs)."""
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        num_workers = min(num_workers, len(xs))
+        if num_workers <= 1:
+            return [self.encode(x) for x in xs]
+
+        # each worker builds its own tokenizer once, rather than having it
+        # pickled along with every chunk of inputs
+        with Pool(
+            processes=num_workers,
+            initializer=_init_worker_tokenizer,
+            initargs=(self.cfg,),
+        ) as pool:
+            return pool.map(
+                _encode_with_worker_tokenizer,
+                xs,
+                chunksize=max(1, len(xs) // (4 * num_workers)),
+            )
+
     def decode(self, x: str) -> str:
         return self.detok.detokenize(x.split())
+
+
+_worker_tokenizer: Optional[MosesTokenizer] = None
+
+
+def _init_worker_tokenizer(cfg: MosesTokenizerConfig):
+    global _worker_tokenizer
+    _worker_tokenizer = MosesTokenizer(cfg)
+
+
+def _encode_with_worker_tokenizer(x: str) -> str:
+    return _worker_tokenizer.encode(x)
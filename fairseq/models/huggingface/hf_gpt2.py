@@ -83,6 +83,13 @@ class HuggingFaceGPT2Decoder(FairseqIncrementalDecoder):
         self.model.transformer.wte.weight.data[self.pad_idx].zero_()
         self.model.transformer.wpe.weight.data[0].zero_()
 
+        # position ids start at 1, since position 0 is reserved for padding
+        self.register_buffer(
+            "_pos_ids",
+            torch.arange(1, 1 + args.max_target_positions).unsqueeze(0),
+            persistent=False,
+        )
+
     def forward(
         self,
         prev_output_tokens,
@@ -99,8 +106,8 @@ class HuggingFaceGPT2Decoder(FairseqIncrementalDecoder):
         prev_output_tokens,
         incremental_state: Optional[Dict[str, List[torch.Tensor]]] = None,
     ):
-        if incremental_state:
-            past = self.get_incremental_state("past")
+        if incremental_state is not None:
+            past = self.get_incremental_state(incremental_state, "past")
         else:
             past = None
 
@@ -108,25 +115,45 @@ class HuggingFaceGPT2Decoder(FairseqIncrementalDecoder):
         attention_mask = prev_output_tokens.ne(self.pad_idx).int()
 
         # set position ids to exclude padding symbols
-        position_ids = attention_mask * (
-            torch.arange(1, 1 + prev_output_tokens.size(1))
-            .to(prev_output_tokens)
-            .repeat(prev_output_tokens.size(0), 1)
-        )
+        position_ids = attention_mask * self._pos_ids[:, : prev_output_tokens.size(1)]
+
+        if past is not None:
+            # keys/values of earlier positions are cached in past, so only the
+            # last token needs to be fed; attention_mask still covers all keys
+            prev_output_tokens = prev_output_tokens[:, -1:]
+            position_ids = position_ids[:, -1:]
 
         outputs = self.model.transformer(
             input_ids=prev_output_tokens,
-            past=past,
+            past_key_values=past,
             attention_mask=attention_mask,
             position_ids=position_ids,
+            use_cache=incremental_state is not None,
         )
         last_hidden_states = outputs[0]
 
-        if incremental_state:
+        if incremental_state is not None:
             self.set_incremental_state(incremental_state, "past", outputs[1])
 
         return last_hidden_states
 
+    def reorder_incremental_state(
+        self,
+        incremental_state: Dict[str, Dict[str, Optional[torch.Tensor]]],
+        new_order: torch.Tensor,
+    ):
+        past = self.get_incremental_state(incremental_state, "past")
+        if past is None:
+            return
+        if hasattr(past, "reorder_cache"):
+            past.reorder_cache(new_order)
+        else:
+            past = tuple(
+                tuple(p.index_select(0, new_order) for p in layer_past)
+                for layer_past in past
+            )
+        self.set_incremental_state(incremental_state, "past", past)
+
     def max_positions(self):
         return self.model.config.n_positions - 1
 
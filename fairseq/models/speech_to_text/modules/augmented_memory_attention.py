@@ -3,21 +3,29 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
-from typing import List, Tuple
+import functools
+from typing import List, Optional, Tuple
 
 import torch
 import torch.nn.functional as F
 from torch import Tensor, nn
 
+from fairseq.data.data_utils import lengths_to_padding_mask
 from fairseq.models import FairseqEncoder
 from fairseq.models.speech_to_text import ConvTransformerEncoder
 from fairseq.models.speech_to_text.utils import (
-    attention_suppression,
-    lengths_to_encoder_padding_mask,
+    attention_suppression_softmax,
     segments_to_sequence,
     sequence_to_segments,
 )
 from fairseq.modules import MultiheadAttention, TransformerEncoderLayer
+from fairseq.modules.quant_noise import quant_noise
+
+
+@functools.lru_cache(maxsize=None)
+def _compile(fn):
+    return torch.compile(fn, dynamic=True, fullgraph=False)
+
 
 # ------------------------------------------------------------------------------
 #   AugmentedMemoryConvTransformerEncoder
@@ -28,6 +36,11 @@ class AugmentedMemoryConvTransformerEncoder(ConvTransformerEncoder):
     def __init__(self, args):
         super().__init__(args)
 
+        # time axis stride of the conv subsampling layers
+        self._stride = 1
+        for layer in self.conv:
+            self._stride *= getattr(layer, "stride", (1,))[0]
+
         args.encoder_stride = self.stride()
 
         self.left_context = args.left_context // args.encoder_stride
@@ -46,9 +59,7 @@ class AugmentedMemoryConvTransformerEncoder(ConvTransformerEncoder):
         )
 
     def stride(self):
-        # Hard coded here. Should infer from convs in future
-        stride = 4
-        return stride
+        return self._stride
 
     def forward(self, src_tokens, src_lengths, states=None):
         """Encode input sequence.
@@ -70,14 +81,12 @@ class AugmentedMemoryConvTransformerEncoder(ConvTransformerEncoder):
         x = self.embed_scale * x
 
         subsampling_factor = 1.0 * max_seq_len / output_seq_len
-        input_lengths = torch.max(
+        input_lengths = torch.min(
             (src_lengths.float() / subsampling_factor).ceil().long(),
             x.size(0) * src_lengths.new_ones([src_lengths.size(0)]).long(),
         )
 
-        encoder_padding_mask, _ = lengths_to_encoder_padding_mask(
-            input_lengths, batch_first=True
-        )
+        encoder_padding_mask = lengths_to_padding_mask(input_lengths)
 
         # TODO: fix positional embedding
         positions = self.embed_positions(encoder_padding_mask).transpose(0, 1)
@@ -88,7 +97,7 @@ class AugmentedMemoryConvTransformerEncoder(ConvTransformerEncoder):
         # State to store memory banks etc.
         if states is None:
             states = [
-                {"memory_banks": None, "encoder_states": None}
+                {"memory_kv": None, "encoder_states": None}
                 for i in range(len(self.transformer_layers))
             ]
 
@@ -96,8 +105,7 @@ class AugmentedMemoryConvTransformerEncoder(ConvTransformerEncoder):
             # x size:
             # (self.left_size + self.segment_size + self.right_size)
             # / self.stride, num_heads, dim
-            # TODO: Consider mask here
-            x = layer(x, states[i])
+            x = layer(x, states[i], encoder_padding_mask)
             states[i]["encoder_states"] = x[
                 self.left_context_after_stride : -self.right_context_after_stride
             ]
@@ -125,7 +133,7 @@ class AugmentedMemoryTransformerEncoderLayer(TransformerEncoderLayer):
         self.left_context = args.left_context // args.encoder_stride
         self.right_context = args.right_context // args.encoder_stride
 
-    def forward(self, x, state):
+    def forward(self, x, state, encoder_padding_mask=None):
 
         length, batch_size, x_dim = x.size()
 
@@ -134,10 +142,6 @@ class AugmentedMemoryTransformerEncoderLayer(TransformerEncoderLayer):
         if self.normalize_before:
             x = self.self_attn_layer_norm(x)
 
-        # init_state
-        if state.get("memory_banks", None) is None:
-            state["memory_banks"] = []
-
         # TODO reseach new sum_query method
         seg_start = self.left_context
         seg_end = length - self.right_context
@@ -148,7 +152,11 @@ class AugmentedMemoryTransformerEncoderLayer(TransformerEncoderLayer):
 
         x = torch.cat([x, summarization_query], dim=0)
 
-        x = self.self_attn(input_and_summary=x, state=state)
+        x = self.self_attn(
+            input_and_summary=x,
+            state=state,
+            key_padding_mask=encoder_padding_mask,
+        )
 
         x = self.dropout_module(x)
         x = residual + x
@@ -180,6 +188,8 @@ class AugmentedMemoryTransformerEncoderLayer(TransformerEncoderLayer):
             qn_block_size=self.quant_noise_block_size,
             tanh_on_mem=True,
             max_memory_size=args.max_memory_size,
+            std_scale=getattr(args, "std_scale", 0.5),
+            compile_attention=getattr(args, "compile_attention", False),
         )
 
 
@@ -213,28 +223,42 @@ class AugmentedMemoryMultiheadAttention(MultiheadAttention):
         std_scale=0.5,  # 0.5 based on https://arxiv.org/abs/2005.09137
         max_memory_size=-1,
         disable_mem_on_mem_attn=True,
+        compile_attention=False,
     ):
         super().__init__(
             embed_dim,
             num_heads,
-            kdim,
-            vdim,
-            dropout,
-            bias,
-            add_bias_kv,
-            add_zero_attn,
-            self_attention,
-            encoder_decoder_attention,
-            q_noise,
-            qn_block_size,
+            kdim=kdim,
+            vdim=vdim,
+            dropout=dropout,
+            bias=bias,
+            add_bias_kv=add_bias_kv,
+            add_zero_attn=add_zero_attn,
+            self_attention=self_attention,
+            encoder_decoder_attention=encoder_decoder_attention,
+            q_noise=q_noise,
+            qn_block_size=qn_block_size,
         )
 
         self.memory_dim = memory_dim if memory_dim is not None else embed_dim
         self.std_scale = std_scale
         self.disable_mem_on_mem_attn = disable_mem_on_mem_attn
 
-        # This Operator was used for factorization in PySpeech
-        self.v2e = lambda x: x
+        # Keys and values are always projected from the same memory-and-input
+        # tensor, so compute both with a single fused matmul
+        self.kv_proj = quant_noise(
+            nn.Linear(embed_dim, 2 * embed_dim, bias=bias), q_noise, qn_block_size
+        )
+        with torch.no_grad():
+            self.kv_proj.weight.copy_(
+                torch.cat([self.k_proj.weight, self.v_proj.weight], dim=0)
+            )
+            if bias:
+                self.kv_proj.bias.copy_(
+                    torch.cat([self.k_proj.bias, self.v_proj.bias], dim=0)
+                )
+        del self.k_proj
+        del self.v_proj
 
         if tanh_on_mem:
             self.squash_mem = torch.tanh
@@ -245,38 +269,48 @@ class AugmentedMemoryMultiheadAttention(MultiheadAttention):
 
         self.max_memory_size = max_memory_size
 
-    def forward(self, input_and_summary, state):
+        # opt-in: the first forward pays the torch.compile cost and needs the
+        # inductor toolchain (e.g. a C++ compiler on CPU)
+        if compile_attention and not hasattr(torch, "compile"):
+            raise ImportError("compile_attention requires PyTorch >= 2.0")
+        self.compile_attention = compile_attention
+
+    def forward(self, input_and_summary, state, key_padding_mask=None):
         """
         input: Encoder states of current segment with left or right context,
             plus one summarization query
+        key_padding_mask: optional [B, T] mask of padded positions in the
+            current segment; it is applied with masked_fill, so an all-False
+            mask costs no device sync
 
         """
 
         length, batch_size, _ = input_and_summary.shape
         length = length - 1  # not include sum_query, last index
 
-        memory = state["memory_banks"]
-        # TODO: positional embedding on memory
-
-        if self.max_memory_size > -1 and len(memory) > self.max_memory_size:
-            # TODO: need to fix here
-            if self.max_memory_size == 0:
-                memory = memory.new_zeros(1, memory.size(1), self.memory_dim)
-            else:
-                memory = memory[-self.max_memory_size :]
+        # init_state
+        if state.get("memory_kv", None) is None:
+            state["mem_len"] = 0
+            state["mem_head"] = 0
 
-        memory_and_input = torch.cat(memory + [input_and_summary[:-1]], dim=0)
-        input_and_sum_query = input_and_summary
+        # Memory banks are immutable once appended, so their projected keys
+        # and values are cached in state and only the new segment is projected
+        mem_len = state["mem_len"]
+        # TODO: positional embedding on memory
 
-        q = self.q_proj(self.v2e(input_and_sum_query))
-        k = self.k_proj(self.v2e(memory_and_input))
-        v = self.v_proj(self.v2e(memory_and_input))
+        q = self.q_proj(input_and_summary)
+        kv = self.kv_proj(input_and_summary[:-1])
+        if mem_len > 0:
+            # memory slots are unordered in the ring buffer, which is fine as
+            # memory carries no positional information. Keys and values are
+            # cached fused, so a single concat covers both.
+            kv = torch.cat((state["memory_kv"][:mem_len], kv), dim=0)
+        k, v = kv.chunk(2, dim=-1)
 
         q = (
             q.contiguous()
             .view(-1, batch_size * self.num_heads, self.head_dim)
             .transpose(0, 1)
-            * self.scaling
         )
         k = (
             k.contiguous()
@@ -290,30 +324,77 @@ class AugmentedMemoryMultiheadAttention(MultiheadAttention):
             .transpose(0, 1)
         )
 
-        attention_weights = torch.bmm(q, k.transpose(1, 2))
-
-        if self.disable_mem_on_mem_attn:
-            attention_weights = self.suppress_mem_on_mem_attention(
-                batch_size, self.num_heads, len(memory), attention_weights
+        if self.compile_attention:
+            attention_core = functools.partial(
+                _compile(AugmentedMemoryMultiheadAttention._attention_core), self
             )
+        else:
+            attention_core = self._attention_core
+        output, next_m = attention_core(q, k, v, key_padding_mask, mem_len)
 
-        if self.std_scale is not None:
-            attention_weights = attention_suppression(attention_weights, self.std_scale)
+        self.append_memory(state, self.kv_proj(next_m))
 
-        assert list(attention_weights.shape) == [
-            batch_size * self.num_heads,
-            length + 1,
-            length + len(memory),
-        ]
+        return output
 
-        attention_weights = torch.nn.functional.softmax(
-            attention_weights.float(), dim=-1
-        ).type_as(attention_weights)
+    def append_memory(self, state, next_kv: Tensor):
+        """
+        Write the fused key/value projection ([1, B, 2D]) of a new memory
+        bank entry into the [capacity, B, 2D] state["memory_kv"] buffer.
+        Attention only ever reads the projected memory, so the raw memory
+        bank entries are not kept.
+
+        With max_memory_size > -1 the buffer is a preallocated ring buffer
+        and the oldest entry is overwritten once it is full; otherwise it
+        grows by doubling its capacity.
+        """
+        if self.max_memory_size == 0:
+            return
+
+        head = state["mem_head"]
+        memory_kv = state.get("memory_kv", None)
+        if memory_kv is None:
+            capacity = self.max_memory_size if self.max_memory_size > 0 else 1
+            memory_kv = next_kv.new_empty((capacity,) + next_kv.shape[1:])
+        elif self.max_memory_size < 0 and head == memory_kv.size(0):
+            memory_kv = torch.cat((memory_kv, torch.empty_like(memory_kv)))
+
+        memory_kv[head] = next_kv[0]
+        state["memory_kv"] = memory_kv
+
+        if self.max_memory_size > 0:
+            state["mem_head"] = (head + 1) % self.max_memory_size
+            state["mem_len"] = min(state["mem_len"] + 1, self.max_memory_size)
+        else:
+            state["mem_head"] = head + 1
+            state["mem_len"] = head + 1
 
-        attention_probs = self.dropout_module(attention_weights)
+    def _attention_core(
+        self,
+        q: Tensor,
+        k: Tensor,
+        v: Tensor,
+        key_padding_mask: Optional[Tensor],
+        num_mem: int,
+    ) -> Tuple[Tensor, Tensor]:
+        """
+        Arguments:
+            - q: a [B*num_heads, T + 1, head_dim] tensor
+            - k, v: [B*num_heads, num_mem + T, head_dim] tensors
+            - key_padding_mask: optional [B, T] mask of padded input positions
+            - num_mem: size of memory bank
 
-        # [T, T, B, n_head] + [T, B, n_head, d_head] -> [T, B, n_head, d_head]
-        attention = torch.bmm(attention_probs, v)
+        Return:
+            output of the current segment ([T, B, D]) and the next memory
+            bank entry ([1, B, D])
+        """
+        bsz_x_heads, length, _ = q.shape
+        batch_size = bsz_x_heads // self.num_heads
+        length = length - 1  # not include sum_query, last index
+
+        if self.std_scale is None and hasattr(F, "scaled_dot_product_attention"):
+            attention = self._sdpa_attention(q, k, v, key_padding_mask, num_mem)
+        else:
+            attention = self._bmm_attention(q, k, v, key_padding_mask, num_mem)
 
         assert list(attention.shape) == [
             batch_size * self.num_heads,
@@ -333,9 +414,136 @@ class AugmentedMemoryMultiheadAttention(MultiheadAttention):
         next_m = self.squash_mem(next_m)
         output = output_and_memory[:-1]
 
-        state["memory_banks"].append(next_m)
+        return output, next_m
 
-        return output
+    def _bmm_attention(
+        self,
+        q: Tensor,
+        k: Tensor,
+        v: Tensor,
+        key_padding_mask: Optional[Tensor],
+        num_mem: int,
+    ) -> Tensor:
+        bsz_x_heads, length, _ = q.shape
+        batch_size = bsz_x_heads // self.num_heads
+        length = length - 1  # not include sum_query, last index
+
+        # scale q by folding self.scaling into the matmul; with beta=0 the
+        # (broadcast) input tensor is ignored
+        attention_weights = torch.baddbmm(
+            q.new_zeros(()), q, k.transpose(1, 2), beta=0.0, alpha=self.scaling
+        )
+
+        if self.disable_mem_on_mem_attn:
+            attention_weights = self.suppress_mem_on_mem_attention(
+                batch_size, self.num_heads, num_mem, attention_weights
+            )
+
+        assert list(attention_weights.shape) == [
+            batch_size * self.num_heads,
+            length + 1,
+            length + num_mem,
+        ]
+
+        if key_padding_mask is not None:
+            # memory bank entries are never padded
+            key_padding_mask = F.pad(key_padding_mask, (num_mem, 0), value=False)
+            attention_weights = (
+                attention_weights.view(batch_size, self.num_heads, length + 1, -1)
+                .masked_fill(
+                    key_padding_mask.view(batch_size, 1, 1, -1).to(torch.bool),
+                    float("-inf"),
+                )
+                .view(batch_size * self.num_heads, length + 1, -1)
+            )
+            # A row whose keys are all masked (e.g. a fully padded utterance)
+            # would turn into nan after softmax. Give such rows one finite
+            # entry here and zero their probabilities after softmax, rather
+            # than checking for nan afterwards, which needs a host sync.
+            fully_masked = attention_weights.eq(float("-inf")).all(dim=-1, keepdim=True)
+            first_key = torch.arange(attention_weights.size(-1), device=q.device) == 0
+            attention_weights = attention_weights.masked_fill(
+                fully_masked & first_key, 0.0
+            )
+        else:
+            fully_masked = None
+
+        if self.std_scale is not None:
+            attention_weights = attention_suppression_softmax(
+                attention_weights, self.std_scale
+            )
+        else:
+            attention_weights = torch.nn.functional.softmax(
+                attention_weights, dim=-1, dtype=torch.float32
+            ).type_as(attention_weights)
+
+        if fully_masked is not None:
+            attention_weights = attention_weights.masked_fill(fully_masked, 0.0)
+
+        attention_probs = self.dropout_module(attention_weights)
+
+        # [T, T, B, n_head] + [T, B, n_head, d_head] -> [T, B, n_head, d_head]
+        attention = torch.bmm(attention_probs, v)
+
+        return attention
+
+    def _sdpa_attention(
+        self,
+        q: Tensor,
+        k: Tensor,
+        v: Tensor,
+        key_padding_mask: Optional[Tensor],
+        num_mem: int,
+    ) -> Tensor:
+        """
+        Same as _bmm_attention without attention suppression, computed with
+        F.scaled_dot_product_attention so that the fused (memory-efficient /
+        flash) kernels are used and the full score matrix is never
+        materialized. Memory-on-memory and padding masking are expressed as
+        a boolean attn_mask (True = attend).
+        """
+        bsz_x_heads, length, _ = q.shape
+        batch_size = bsz_x_heads // self.num_heads
+        key_length = k.size(1)
+
+        attn_mask = None
+        if self.disable_mem_on_mem_attn and num_mem > 0:
+            # the summarization query (last row) does not attend to memory
+            attn_mask = torch.ones(
+                length, key_length, dtype=torch.bool, device=q.device
+            )
+            attn_mask[-1, :num_mem] = False
+
+        if key_padding_mask is not None:
+            # memory bank entries are never padded
+            key_padding_mask = F.pad(key_padding_mask, (num_mem, 0), value=False)
+            not_padded = ~key_padding_mask.to(torch.bool).view(
+                batch_size, 1, 1, key_length
+            )
+            attn_mask = not_padded if attn_mask is None else attn_mask & not_padded
+            # let rows without any key to attend to (e.g. a fully padded
+            # utterance) attend everywhere, and zero their output below
+            fully_masked = ~attn_mask.any(dim=-1, keepdim=True)
+            attn_mask = attn_mask | fully_masked
+        else:
+            fully_masked = None
+
+        dropout_p = self.dropout_module.p
+        if not (self.training or self.dropout_module.apply_during_inference):
+            dropout_p = 0.0
+
+        attention = F.scaled_dot_product_attention(
+            q.view(batch_size, self.num_heads, length, self.head_dim),
+            k.view(batch_size, self.num_heads, key_length, self.head_dim),
+            v.view(batch_size, self.num_heads, key_length, self.head_dim),
+            attn_mask=attn_mask,
+            dropout_p=dropout_p,
+        )
+
+        if fully_masked is not None:
+            attention = attention.masked_fill(fully_masked, 0.0)
+
+        return attention.reshape(bsz_x_heads, length, self.head_dim)
 
     def suppress_mem_on_mem_attention(
         self, B: int, num_heads: int, mem_size: int, attention_weight: Tensor
@@ -353,6 +561,18 @@ class AugmentedMemoryMultiheadAttention(MultiheadAttention):
         attention_weight[:, -1, :mem_size] = float("-inf")
         return attention_weight
 
+    def upgrade_state_dict_named(self, state_dict, name):
+        super().upgrade_state_dict_named(state_dict, name)
+        prefix = name + "." if name != "" else ""
+        # merge separate k_proj / v_proj parameters into the fused kv_proj
+        for param in ["weight", "bias"]:
+            k_key = prefix + "k_proj." + param
+            v_key = prefix + "v_proj." + param
+            if k_key in state_dict and v_key in state_dict:
+                state_dict[prefix + "kv_proj." + param] = torch.cat(
+                    [state_dict.pop(k_key), state_dict.pop(v_key)], dim=0
+                )
+
 
 # ------------------------------------------------------------------------------
 #   SequenceEncoder
@@ -419,9 +639,7 @@ class SequenceEncoder(FairseqEncoder):
             segments=seg_encoder_states_lengths, time_axis=self.output_time_axis
         )
 
-        encoder_padding_mask, _ = lengths_to_encoder_padding_mask(
-            enc_lengths, batch_first=True
-        )
+        encoder_padding_mask = lengths_to_padding_mask(enc_lengths)
 
         if not encoder_padding_mask.any():
             encoder_padding_mask = None
@@ -456,6 +674,10 @@ class SequenceEncoder(FairseqEncoder):
 # ------------------------------------------------------------------------------
 #   Augmented memory model decorator
 # ------------------------------------------------------------------------------
+def _float_or_none(value: str) -> Optional[float]:
+    return None if value.lower() == "none" else float(value)
+
+
 def augmented_memory(klass):
     class StreamSeq2SeqModel(klass):
         @staticmethod
@@ -482,6 +704,20 @@ def augmented_memory(klass):
                 default=-1,
                 help="Right context for the segment.",
             )
+            parser.add_argument(
+                "--std-scale",
+                type=_float_or_none,
+                default=0.5,
+                help="Scale of the std threshold for weak attention "
+                "suppression; 'none' disables suppression.",
+            )
+            parser.add_argument(
+                "--compile-attention",
+                action="store_true",
+                default=False,
+                help="Compile the augmented memory attention core with "
+                "torch.compile (requires PyTorch >= 2.0).",
+            )
 
     StreamSeq2SeqModel.__name__ = klass.__name__
     return StreamSeq2SeqModel
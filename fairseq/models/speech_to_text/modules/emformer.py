@@ -20,7 +20,7 @@ from torch import device as Device
 from fairseq.models import FairseqEncoder
 from fairseq.models.speech_to_text.utils import (
     NoOp,
-    attention_suppression,
+    attention_suppression_softmax,
     layer_norm_backward_hook,
     lengths_to_padding_mask,
     segments_to_sequence,
@@ -468,13 +468,13 @@ class NoSegAugmentedMemoryMultiheadAttentionBmm(nn.Module):
             )
 
         if self.std_scale is not None:
-            attention_weights_float = attention_suppression(
+            attention_weights_float = attention_suppression_softmax(
                 attention_weights_float, self.std_scale
             )
-
-        attention_weights_float = torch.nn.functional.softmax(
-            attention_weights_float, dim=-1
-        )
+        else:
+            attention_weights_float = torch.nn.functional.softmax(
+                attention_weights_float, dim=-1
+            )
         attention_weights = attention_weights_float.type_as(attention_weights)
 
         attention_probs = torch.nn.functional.dropout(
@@ -520,43 +520,74 @@ def lengths_to_encoder_padding_mask(lengths, batch_first: bool = False):
 # ------------------------------------------------------------------------------
 
 
-def attention_suppression(attention_weights: Tensor, scale: float):
-    # B, H, qlen, klen -> B, H, qlen, 1
-    attention_prob = torch.nn.functional.softmax(attention_weights.float(), dim=-1)
-    attention_nozeros = attention_prob.to(torch.bool)
-    nozeros_sum = torch.sum(attention_nozeros.to(torch.float), dim=-1, keepdim=True)
+def _attention_suppression_mask(attention_prob: Tensor, scale: float):
+    # The threshold only feeds a boolean mask, so nothing here needs to be
+    # kept for backward and temporaries can be updated in place
+    with torch.no_grad():
+        # B, H, qlen, klen -> B, H, qlen, 1
+        attention_nozeros = attention_prob.to(torch.bool)
+        nozeros_sum = torch.sum(
+            attention_nozeros, dim=-1, keepdim=True, dtype=torch.float
+        )
 
-    # For very sparse situation, we need get round about 0s
-    key_sum = torch.sum(attention_prob, dim=-1, keepdim=True)
+        # For very sparse situation, we need get round about 0s
+        key_sum = torch.sum(attention_prob, dim=-1, keepdim=True)
 
-    # nozeros_sum should > 1
-    key_mean = key_sum / (nozeros_sum + 1e-8)
+        # nozeros_sum should > 1
+        key_mean = key_sum / (nozeros_sum + 1e-8)
 
-    # std calculation
-    dis = (attention_prob - key_mean) * (attention_prob - key_mean)
+        # std calculation
+        # if attention_prob[i] < threshold, then dis[i] = 0; for all i
+        dis = (
+            (attention_prob - key_mean).square_().masked_fill_(~attention_nozeros, 0.0)
+        )
 
-    # if attention_prob[i] < threshold, then dis_masked[i] = 0; for all i
-    dis_masked = torch.where(
-        attention_nozeros, dis, attention_prob.new_zeros(attention_prob.size())
-    )
+        key_var = torch.sum(dis, dim=-1, keepdim=True)
+        key_var = key_var / (nozeros_sum - 1.0 + 1e-8)
+        key_std = torch.sqrt(key_var)
+        key_thread = key_mean - scale * key_std
+
+        return attention_prob < key_thread
+
+
+def attention_suppression(attention_weights: Tensor, scale: float):
+    """
+    Return attention_weights with the weakly attended entries set to -inf.
 
-    key_var = torch.sum(dis_masked, dim=-1, keepdim=True)
-    key_var = key_var / (nozeros_sum - 1.0 + 1e-8)
-    key_std = torch.sqrt(key_var)
-    key_thread = key_mean - scale * key_std
+    The attention modules in this package use attention_suppression_softmax
+    instead; this logit-space variant is kept as public API for callers that
+    need the suppressed weights rather than probabilities.
+    """
+    attention_prob = torch.nn.functional.softmax(
+        attention_weights, dim=-1, dtype=torch.float32
+    )
 
     # if attention_prob[i] >= key_thread, then attention_prob[i]
     # , otherwise "-inf"
-    inf_tensor = attention_prob.new_zeros(attention_prob.size()).detach()
-    inf_tensor[:] = float("-inf")
-    attention_weights_float = torch.where(
-        attention_prob < key_thread,
-        inf_tensor,
-        attention_weights.float(),
+    attention_weights_float = attention_weights.float().masked_fill(
+        _attention_suppression_mask(attention_prob, scale), float("-inf")
     )
 
     return attention_weights_float.type_as(attention_weights)
 
 
+def attention_suppression_softmax(attention_weights: Tensor, scale: float):
+    """
+    Equivalent to softmax(attention_suppression(attention_weights, scale)),
+    but reuses the probabilities computed for the suppression threshold:
+    suppressed entries are zeroed and each row is renormalized, instead of
+    running a second softmax over the masked weights.
+    """
+    attention_prob = torch.nn.functional.softmax(
+        attention_weights, dim=-1, dtype=torch.float32
+    )
+    attention_prob = attention_prob.masked_fill(
+        _attention_suppression_mask(attention_prob, scale), 0.0
+    )
+    attention_prob = attention_prob / attention_prob.sum(dim=-1, keepdim=True)
+
+    return attention_prob.type_as(attention_weights)
+
+
 def layer_norm_backward_hook(module, grad_input, grad_output, clamp_value):
     return tuple(torch.clamp(v, min=-clamp_value, max=clamp_value) for v in grad_input)
@@ -15,7 +15,11 @@ class FairseqLAMB(LegacyFairseqOptimizer):
         try:
             from apex.optimizers import FusedLAMB
 
-            self._optimizer = FusedLAMB(params, **self.optimizer_config)
+            self._optimizer = FusedLAMB(
+                params,
+                use_nvlamb=getattr(args, "lamb_use_nvlamb", False),
+                **self.optimizer_config,
+            )
         except ImportError:
             raise ImportError("Please install apex to use LAMB optimizer")
 
@@ -29,6 +33,9 @@ class FairseqLAMB(LegacyFairseqOptimizer):
                             help='epsilon for LAMB optimizer')
         parser.add_argument('--weight-decay', '--wd', default=0.0, type=float, metavar='WD',
                             help='weight decay')
+        parser.add_argument('--lamb-use-nvlamb', action='store_true',
+                            help='apply the adaptive trust ratio to all parameters, '
+                                 'including those without weight decay (NVLAMB)')
         # fmt: on
 
     @property
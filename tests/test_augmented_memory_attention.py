@@ -0,0 +1,225 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import argparse
+
+import torch
+
+from fairseq.models.speech_to_text.convtransformer import base_architecture
+from fairseq.models.speech_to_text.modules.augmented_memory_attention import (
+    AugmentedMemoryConvTransformerEncoder,
+    AugmentedMemoryMultiheadAttention,
+    SequenceEncoder,
+)
+from fairseq.models.speech_to_text.utils import (
+    attention_suppression,
+    attention_suppression_softmax,
+)
+
+
+def _make_attention(**kwargs):
+    torch.manual_seed(0)
+    attn = AugmentedMemoryMultiheadAttention(
+        embed_dim=16, num_heads=4, tanh_on_mem=True, **kwargs
+    )
+    attn.eval()
+    return attn
+
+
+def _run_segments(attn, segments):
+    state = {"memory_kv": None}
+    return [attn(input_and_summary=x, state=state) for x in segments]
+
+
+def test_upgrade_state_dict_merges_k_proj_and_v_proj():
+    attn = _make_attention()
+    embed_dim = attn.embed_dim
+
+    # build a checkpoint in the old layout, with separate k_proj / v_proj
+    state_dict = {"encoder.attn." + k: v for k, v in attn.state_dict().items()}
+    kv_weight = state_dict.pop("encoder.attn.kv_proj.weight")
+    kv_bias = state_dict.pop("encoder.attn.kv_proj.bias")
+    state_dict["encoder.attn.k_proj.weight"] = kv_weight[:embed_dim].clone()
+    state_dict["encoder.attn.v_proj.weight"] = kv_weight[embed_dim:].clone()
+    state_dict["encoder.attn.k_proj.bias"] = kv_bias[:embed_dim].clone()
+    state_dict["encoder.attn.v_proj.bias"] = kv_bias[embed_dim:].clone()
+
+    attn.upgrade_state_dict_named(state_dict, "encoder.attn")
+
+    for proj in ["k_proj", "v_proj"]:
+        for param in ["weight", "bias"]:
+            assert "encoder.attn.{}.{}".format(proj, param) not in state_dict
+    assert torch.equal(state_dict["encoder.attn.kv_proj.weight"], kv_weight)
+    assert torch.equal(state_dict["encoder.attn.kv_proj.bias"], kv_bias)
+
+    upgraded = AugmentedMemoryMultiheadAttention(
+        embed_dim=16, num_heads=4, tanh_on_mem=True
+    )
+    upgraded.load_state_dict(
+        {k[len("encoder.attn.") :]: v for k, v in state_dict.items()}, strict=True
+    )
+    upgraded.eval()
+
+    segments = [torch.randn(5, 2, embed_dim) for _ in range(3)]
+    with torch.no_grad():
+        for out, ref in zip(
+            _run_segments(upgraded, segments), _run_segments(attn, segments)
+        ):
+            assert torch.allclose(out, ref)
+
+
+def test_train_forward_with_quant_noise():
+    torch.manual_seed(1)
+    segments = [torch.randn(5, 2, 16) for _ in range(3)]
+
+    for q_noise in [0.0, 0.25]:
+        attn = _make_attention(q_noise=q_noise, qn_block_size=8, dropout=0.1)
+        attn.train()
+        outputs = _run_segments(attn, segments)
+        torch.stack(outputs).sum().backward()
+        for name, param in attn.named_parameters():
+            assert param.grad is not None, name
+            assert torch.isfinite(param.grad).all(), name
+
+
+def test_attention_suppression_softmax_matches_suppression_then_softmax():
+    torch.manual_seed(0)
+    attention_weights = torch.randn(8, 6, 10)
+    # memory-on-memory masking leaves -inf entries in the summary query row
+    attention_weights[:, -1, :3] = float("-inf")
+
+    for scale in [0.0, 0.5, 1.0]:
+        expected = torch.nn.functional.softmax(
+            attention_suppression(attention_weights, scale).float(), dim=-1
+        )
+        result = attention_suppression_softmax(attention_weights, scale)
+        assert result.dtype == attention_weights.dtype
+        assert torch.allclose(result, expected, atol=1e-6)
+
+
+def _list_memory_reference(attn, segments):
+    """
+    Segment-by-segment outputs of attn computed with the original memory
+    layout: a growing list of raw memory bank entries, truncated to the last
+    max_memory_size entries and re-projected on every segment.
+    """
+    memory = []
+    outputs = []
+    for x in segments:
+        batch_size = x.size(1)
+        if attn.max_memory_size > -1:
+            memory = memory[len(memory) - attn.max_memory_size :]
+        k, v = attn.kv_proj(torch.cat(memory + [x[:-1]], dim=0)).chunk(2, dim=-1)
+        q, k, v = (
+            t.contiguous()
+            .view(-1, batch_size * attn.num_heads, attn.head_dim)
+            .transpose(0, 1)
+            for t in (attn.q_proj(x), k, v)
+        )
+        output, next_m = attn._attention_core(q, k, v, None, len(memory))
+        memory.append(next_m)
+        outputs.append(output)
+    return outputs
+
+
+def test_memory_ring_buffer_matches_list_memory():
+    torch.manual_seed(1)
+    segments = [torch.randn(5, 2, 16) for _ in range(6)]
+
+    for max_memory_size in [1, 2, -1]:
+        for disable_mem_on_mem_attn in [True, False]:
+            attn = _make_attention(
+                max_memory_size=max_memory_size,
+                disable_mem_on_mem_attn=disable_mem_on_mem_attn,
+            )
+            with torch.no_grad():
+                outputs = _run_segments(attn, segments)
+                expected = _list_memory_reference(attn, segments)
+            for out, ref in zip(outputs, expected):
+                assert torch.allclose(out, ref, atol=1e-6)
+
+
+def test_sdpa_attention_matches_bmm_attention():
+    batch_size, length, embed_dim = 3, 5, 16
+    # the last utterance is fully padded
+    key_padding_mask = torch.tensor(
+        [
+            [False] * length,
+            [False] * 3 + [True] * 2,
+            [True] * length,
+        ]
+    )
+
+    for disable_mem_on_mem_attn in [True, False]:
+        attn = _make_attention(
+            std_scale=None, disable_mem_on_mem_attn=disable_mem_on_mem_attn
+        )
+        for num_mem in [0, 2]:
+            for mask in [None, key_padding_mask]:
+                q, k, v = (
+                    torch.randn(batch_size * attn.num_heads, n, attn.head_dim)
+                    for n in (length + 1, num_mem + length, num_mem + length)
+                )
+                with torch.no_grad():
+                    sdpa = attn._sdpa_attention(q, k, v, mask, num_mem)
+                    bmm = attn._bmm_attention(q, k, v, mask, num_mem)
+                assert torch.isfinite(sdpa).all()
+                assert torch.allclose(sdpa, bmm, atol=1e-6)
+
+
+def _make_encoder():
+    args = argparse.Namespace(
+        input_feat_per_channel=8,
+        encoder_embed_dim=16,
+        encoder_ffn_embed_dim=32,
+        encoder_layers=2,
+        encoder_attention_heads=4,
+        conv_out_channels=4,
+        dropout=0.0,
+        segment_size=16,
+        left_context=8,
+        right_context=8,
+        max_memory_size=-1,
+    )
+    base_architecture(args)
+    torch.manual_seed(0)
+    encoder = SequenceEncoder(args, AugmentedMemoryConvTransformerEncoder(args))
+    encoder.eval()
+    return encoder
+
+
+def test_encoder_segment_lengths_and_padding_mask():
+    encoder = _make_encoder()
+    # one segment: 8 frames of left context, 32 frames, 8 of right context
+    src_tokens = torch.randn(3, 48, 8)
+    src_lengths = torch.tensor([48, 30, 12])
+
+    with torch.no_grad():
+        encoder_states, lengths, states = encoder.module(src_tokens, src_lengths)
+
+    # the conv subsampling has stride 4, so the segment has 12 frames with
+    # ceil(src_lengths / 4) = [12, 8, 3] unpadded ones, and 2 frames of left
+    # and right context are stripped from the output
+    assert encoder_states.shape == (8, 3, 16)
+    assert lengths.squeeze(1).tolist() == [8, 6, 1]
+    assert torch.isfinite(encoder_states).all()
+
+
+def test_sequence_encoder_padding_mask():
+    encoder = _make_encoder()
+    src_tokens = torch.randn(3, 64, 8)
+    src_lengths = torch.tensor([64, 40, 10])
+
+    with torch.no_grad():
+        encoder_out = encoder(src_tokens, src_lengths)
+
+    encoder_padding_mask = encoder_out["encoder_padding_mask"][0]
+    assert encoder_out["encoder_out"][0].shape == (16, 3, 16)
+    assert encoder_padding_mask.shape == (3, 16)
+    # sequence_to_segments counts the right context of every segment as part
+    # of each utterance, so 40 and 10 frames give 12 and 5 encoder frames
+    assert encoder_padding_mask.sum(dim=1).tolist() == [0, 4, 11]
+    # padding is a suffix of each row
+    assert torch.equal(encoder_padding_mask, encoder_padding_mask.cummax(dim=1).values)
@@ -0,0 +1,87 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import argparse
+import unittest
+
+import torch
+
+try:
+    import transformers
+except ImportError:
+    transformers = None
+
+from fairseq.data import Dictionary
+from fairseq.models.huggingface.hf_gpt2 import HuggingFaceGPT2Decoder
+
+
+class DummyTask:
+    def __init__(self, dictionary):
+        self.target_dictionary = dictionary
+
+
+@unittest.skipIf(not transformers, "Requires transformers install")
+class TestHuggingFaceGPT2Decoder(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        dictionary = Dictionary()
+        for i in range(20):
+            dictionary.add_symbol("w{}".format(i))
+        args = argparse.Namespace(
+            max_target_positions=16,
+            embed_dim=32,
+            num_layers=2,
+            num_attention_heads=4,
+            dropout=0.0,
+            attention_dropout=0.0,
+        )
+        self.decoder = HuggingFaceGPT2Decoder(args, DummyTask(dictionary))
+        self.decoder.eval()
+        self.tokens = torch.randint(
+            dictionary.nspecial, len(dictionary), (2, 6), dtype=torch.long
+        )
+
+    def assertTensorsClose(self, t1, t2):
+        self.assertEqual(t1.size(), t2.size(), "size mismatch")
+        self.assertLess((t1 - t2).abs().max(), 1e-5)
+
+    def full_prefix_logits(self, tokens, step):
+        return self.decoder(tokens[:, : step + 1])[0][:, -1]
+
+    @torch.no_grad()
+    def test_incremental_matches_full_prefix(self):
+        incremental_state = {}
+        for step in range(self.tokens.size(1)):
+            logits = self.decoder(
+                self.tokens[:, : step + 1], incremental_state=incremental_state
+            )[0]
+            self.assertEqual(logits.size(1), 1)
+            self.assertTensorsClose(
+                logits[:, -1], self.full_prefix_logits(self.tokens, step)
+            )
+
+    @torch.no_grad()
+    def test_reorder_incremental_state(self):
+        incremental_state = {}
+        for step in range(3):
+            self.decoder(
+                self.tokens[:, : step + 1], incremental_state=incremental_state
+            )
+
+        # swap and expand the batch, as beam search does
+        new_order = torch.tensor([1, 0, 0])
+        self.decoder.reorder_incremental_state(incremental_state, new_order)
+        tokens = self.tokens.index_select(0, new_order)
+        for step in range(3, tokens.size(1)):
+            logits = self.decoder(
+                tokens[:, : step + 1], incremental_state=incremental_state
+            )[0]
+            self.assertTensorsClose(
+                logits[:, -1], self.full_prefix_logits(tokens, step)
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
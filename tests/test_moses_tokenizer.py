@@ -0,0 +1,49 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import unittest
+
+try:
+    import sacremoses
+except ImportError:
+    sacremoses = None
+
+from fairseq.data.encoders.moses_tokenizer import (
+    MosesTokenizer,
+    MosesTokenizerConfig,
+)
+
+
+@unittest.skipIf(not sacremoses, "Requires sacremoses install")
+class TestMosesTokenizer(unittest.TestCase):
+    def setUp(self):
+        self.tokenizer = MosesTokenizer(MosesTokenizerConfig())
+        self.sentences = [
+            "Hello, world!",
+            'It\'s a state-of-the-art "tokenizer" & more.',
+            "Prices rose 3.5% to $1,000.",
+            "",
+            "Don't split e-mail addresses like foo@bar.com?",
+        ] * 4
+
+    def test_encode_batch_matches_encode(self):
+        self.assertEqual(
+            self.tokenizer.encode_batch(self.sentences, num_workers=2),
+            [self.tokenizer.encode(x) for x in self.sentences],
+        )
+
+    def test_encode_batch_empty(self):
+        self.assertEqual(self.tokenizer.encode_batch([], num_workers=2), [])
+
+    def test_encode_batch_single(self):
+        x = self.sentences[1]
+        self.assertEqual(
+            self.tokenizer.encode_batch([x], num_workers=2),
+            [self.tokenizer.encode(x)],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()